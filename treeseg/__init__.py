@@ -3,6 +3,7 @@ from __future__ import absolute_import
 __version__ = "0.0.1"
 
 from treeseg import base
+from treeseg import cache
 from treeseg import detection
 from treeseg import segmentation
 from treeseg import plot
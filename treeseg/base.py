@@ -5,18 +5,38 @@ import numpy as np
 import rasterio
 import matplotlib.pyplot as plt
 
-class HeightModel:
+class HeightModelBase:
     """
-    The base class for all rasterized height models used for detection and segmentation.
+    The base class for all height models used for detection and segmentation. Derivatives define ``shape``, the number
+    of rows and columns of the grid.
     """
-    def __init__(self, array, crs=None, affine=None):
+    def __init__(self, crs=None, affine=None):
         self.crs = crs
-        self.array = array
         self.affine = affine
 
         self.cell_size_x = self.affine[0]
         self.cell_size_y = abs(self.affine[4])
 
+    @property
+    def _bounding_box(self):
+        min_x, max_y = self.affine[2], self.affine[5]
+        max_x, min_y = min_x + self.cell_size_x * self.shape[1], max_y - self.cell_size_y * self.shape[0]
+        return(min_x, max_x, min_y, max_y)
+
+    @property
+    def _bounding_box_poly(self):
+        min_x, max_x, min_y, max_y = self._bounding_box
+        return Polygon([[min_x, min_y], [min_x, max_y], [max_x, max_y], [max_x, min_y]])
+
+
+class HeightModel(HeightModelBase):
+    """
+    A rasterized height model, stored as a dense array.
+    """
+    def __init__(self, array, crs=None, affine=None):
+        self.array = array
+        super(HeightModel, self).__init__(crs=crs, affine=affine)
+
     @classmethod
     def from_rasterio(cls, rasterio_obj):
         pass
@@ -34,15 +54,11 @@ class HeightModel:
             return cls(pyfor_raster.array, crs=None, affine=None)
 
     @property
-    def _bounding_box(self):
-        min_x, max_y = self.affine[2], self.affine[5]
-        max_x, min_y = min_x + self.cell_size_x * self.array.shape[1], max_y - self.cell_size_y * self.array.shape[0]
-        return(min_x, max_x, min_y, max_y)
-
-    @property
-    def _bounding_box_poly(self):
-        min_x, max_x, min_y, max_y = self._bounding_box
-        return Polygon([[min_x, min_y], [min_x, max_y], [max_x, max_y], [max_x, min_y]])
+    def shape(self):
+        """
+        :return: The number of rows and columns of the height model.
+        """
+        return self.array.shape
 
     def plot(self):
         from treeseg.plot import HeightModelPlot
@@ -51,6 +67,103 @@ class HeightModel:
         plt.show()
 
 
+class SparseHeightModel(HeightModelBase):
+    """
+    A height model that only stores occupied cells. Points are binned directly into a maximum height grid, such that
+    memory grows with the number of occupied cells rather than the bounding box of the points. Cells are stored as
+    parallel arrays of rows, columns and heights, sorted by their position in row-major order.
+
+    Unoccupied cells have no height, rather than a height of zero, and are never detected as local maxima.
+    """
+    def __init__(self, rows, cols, heights, shape, crs=None, affine=None):
+        super(SparseHeightModel, self).__init__(crs=crs, affine=affine)
+        self._shape = shape
+
+        # Row-major positions of the occupied cells, used to look up cells by searching the sorted keys
+        self._keys = rows * shape[1] + cols
+        order = np.argsort(self._keys, kind='stable')
+        self._keys = self._keys[order]
+        self.rows = rows[order]
+        self.cols = cols[order]
+        self.heights = heights[order]
+
+    @classmethod
+    def from_xyz(cls, x, y, z, cell_size, crs=None):
+        """
+        Bins point coordinates into a sparse maximum height grid.
+
+        :param x: An array of x coordinates.
+        :param y: An array of y coordinates.
+        :param z: An array of heights (e.g. normalized point heights).
+        :param cell_size: The width and height of each cell, in the units of the coordinate system.
+        :param crs: The coordinate reference system of the points.
+        """
+        from affine import Affine
+        x, y, z = np.asarray(x), np.asarray(y), np.asarray(z)
+
+        if not len(x) == len(y) == len(z):
+            raise ValueError('x, y and z must have the same length.')
+        if len(x) == 0:
+            raise ValueError('At least one point is required to build a height model.')
+
+        min_x, max_y = x.min(), y.max()
+        cols = np.floor((x - min_x) / cell_size).astype(np.int64)
+        rows = np.floor((max_y - y) / cell_size).astype(np.int64)
+        shape = (int(rows.max()) + 1, int(cols.max()) + 1)
+
+        # Sort by cell, then by height, so the last point of each cell is its maximum
+        keys = rows * shape[1] + cols
+        order = np.lexsort((z, keys))
+        keys, z = keys[order], z[order]
+        last = np.append(keys[1:] != keys[:-1], True)
+        keys, heights = keys[last], z[last]
+
+        affine = Affine(cell_size, 0, min_x, 0, -cell_size, max_y)
+        return cls(keys // shape[1], keys % shape[1], heights, shape, crs=crs, affine=affine)
+
+    @property
+    def shape(self):
+        return self._shape
+
+    def _window_max(self, row_range, col_range):
+        """
+        :param row_range: A ``range`` of rows in the window.
+        :param col_range: A ``range`` of columns in the window.
+        :return: The maximum height of the occupied cells within the window, or ``None`` if no cells are occupied.
+        """
+        if len(row_range) == 0 or len(col_range) == 0:
+            return None
+
+        # Each window row is a contiguous run of the sorted keys
+        window_rows = np.arange(row_range.start, row_range.stop) * self.shape[1]
+        starts = np.searchsorted(self._keys, window_rows + col_range.start)
+        ends = np.searchsorted(self._keys, window_rows + col_range.stop)
+
+        lengths = ends - starts
+        total = lengths.sum()
+        if total == 0:
+            return None
+
+        # Concatenate the runs into a single index array
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self.heights[np.arange(total) + offsets].max()
+
+    def to_dense(self):
+        """
+        Note that unoccupied cells become cells with a height of zero, which are candidates for detection in a dense
+        height model. Detections on the result therefore differ from those on the sparse model wherever the points do
+        not cover the grid.
+
+        :return: A ``HeightModel`` with unoccupied cells set to zero.
+        """
+        array = np.zeros(self.shape)
+        array[self.rows, self.cols] = self.heights
+        return HeightModel(array, crs=self.crs, affine=self.affine)
+
+    def plot(self):
+        self.to_dense().plot()
+
+
 class DetectionBase:
     """
     Holding place for a potential base class for detection
@@ -113,6 +226,69 @@ class DetectionBase:
         else:
             return hmplot
 
+class SparseDetectionBase(DetectionBase):
+    """
+    Detections on a ``SparseHeightModel``. Rather than a boolean array, ``detected`` is an array of the row and column
+    indices of detected cells.
+    """
+
+    @property
+    def _indices_single(self):
+        """
+        :return: The centers of each group of adjacent detected cells, in the same order as ``DetectionBase``.
+        """
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+
+        indices = self.detected[np.lexsort((self.detected[:, 1], self.detected[:, 0]))]
+        if len(indices) == 0:
+            return np.empty((0, 2))
+
+        # Connect detected cells that share an edge, matching the default structure of ``scipy.ndimage.label``
+        keys = indices[:, 0] * self.height_model.shape[1] + indices[:, 1]
+        src, dst = [], []
+        for offset in (1, self.height_model.shape[1]):
+            pos = np.searchsorted(keys, keys + offset)
+            pos[pos == len(keys)] = 0
+            found = keys[pos] == keys + offset
+            if offset == 1:
+                found &= indices[:, 1] + 1 < self.height_model.shape[1]
+            src.append(np.nonzero(found)[0])
+            dst.append(pos[found])
+        src, dst = np.concatenate(src), np.concatenate(dst)
+        graph = coo_matrix((np.ones(len(src)), (src, dst)), shape=(len(keys), len(keys)))
+        labels = connected_components(graph, directed=False)[1]
+
+        # Number the groups in order of their first cell, as a raster scan would
+        _, first = np.unique(labels, return_index=True)
+        relabel = np.empty(len(first), dtype=np.int64)
+        relabel[labels[np.sort(first)]] = np.arange(len(first))
+        labels = relabel[labels]
+
+        counts = np.bincount(labels)
+        centers = np.stack([np.bincount(labels, weights=indices[:, 0]) / counts,
+                            np.bincount(labels, weights=indices[:, 1]) / counts], axis=1)
+        return centers
+
+    @property
+    def _coords_array_multiple(self):
+        return self.project_indices(self.detected)
+
+    def to_dense(self):
+        """
+        Converts to a ``DetectionBase``, e.g. for plotting. The detections are not recomputed; see
+        ``SparseHeightModel.to_dense``.
+
+        :return: A ``DetectionBase`` on the zero-filled dense height model.
+        """
+        height_model = self.height_model.to_dense()
+        detected = np.zeros(height_model.array.shape)
+        detected[self.detected[:, 0], self.detected[:, 1]] = 1
+        return DetectionBase(detected, height_model)
+
+    def plot(self, show=True):
+        return self.to_dense().plot(show=show)
+
 class SegmentationBase:
     def __init__(self, polys, detection_base):
         # TODO implies segmentation always happens after detection (not always true)
@@ -0,0 +1,230 @@
+import os
+import dis
+import types
+import hashlib
+import tempfile
+import functools
+import numpy as np
+from treeseg.base import DetectionBase, SparseHeightModel, SparseDetectionBase
+
+# Included in every cache key. Bump this whenever a change to treeseg alters detection output, so that entries written
+# by earlier versions are no longer returned.
+CACHE_VERSION = 2
+
+
+def _global_names(code):
+    """
+    :return: The set of global names loaded by ``code`` and the code objects nested within it.
+    """
+    names = {instruction.argval for instruction in dis.get_instructions(code) if instruction.opname == 'LOAD_GLOBAL'}
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType):
+            names |= _global_names(const)
+    return names
+
+
+def _fingerprint(obj, seen=frozenset()):
+    """
+    Builds a deterministic description of ``obj`` for the cache key. Functions are described by their code
+    (including nested code objects), defaults, closure values and the values of the globals they load.
+
+    :param obj: The object to describe.
+    :param seen: The ids of the functions and containers already being described, used to terminate cycles.
+    :return: A string.
+    :raises ValueError: If ``obj`` cannot be described deterministically.
+    """
+    if obj is None or isinstance(obj, (bool, int, float, complex, str, bytes)):
+        return repr(obj)
+    if isinstance(obj, np.generic):
+        return repr((type(obj).__name__, obj.item()))
+    if isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            raise ValueError('Cannot fingerprint object arrays.')
+        digest = hashlib.sha1(np.ascontiguousarray(obj).tobytes()).hexdigest()
+        return repr(('ndarray', str(obj.dtype), obj.shape, digest))
+    if isinstance(obj, types.ModuleType):
+        return repr(('module', obj.__name__))
+    if isinstance(obj, types.CodeType):
+        # Nested code objects (comprehensions, inner functions) are in co_consts and are described recursively
+        return repr(('code', obj.co_code, _fingerprint(obj.co_consts, seen), obj.co_names, obj.co_varnames,
+                     obj.co_freevars))
+    if isinstance(obj, (types.BuiltinFunctionType, np.ufunc)):
+        owner = getattr(obj, '__self__', None)
+        if owner is not None and not isinstance(owner, types.ModuleType):
+            raise ValueError('Cannot fingerprint bound method {}.'.format(obj.__name__))
+        return repr(('builtin', getattr(obj, '__module__', None), obj.__name__))
+
+    # The remaining types may contain themselves
+    if id(obj) in seen:
+        return repr(('cycle', type(obj).__name__))
+    seen = seen | {id(obj)}
+
+    if isinstance(obj, (tuple, list)):
+        return repr((type(obj).__name__, [_fingerprint(item, seen) for item in obj]))
+    if isinstance(obj, (set, frozenset)):
+        return repr(('set', sorted(_fingerprint(item, seen) for item in obj)))
+    if isinstance(obj, dict):
+        return repr(('dict', sorted((_fingerprint(k, seen), _fingerprint(v, seen)) for k, v in obj.items())))
+    if isinstance(obj, functools.partial):
+        return repr(('partial', _fingerprint(obj.func, seen), _fingerprint(obj.args, seen),
+                     _fingerprint(obj.keywords, seen)))
+    if isinstance(obj, types.MethodType):
+        return repr(('method', _fingerprint(obj.__func__, seen), _fingerprint(obj.__self__, seen)))
+    if isinstance(obj, types.FunctionType):
+        closure = tuple(cell.cell_contents for cell in obj.__closure__ or ())
+        referenced = [(name, _fingerprint(obj.__globals__[name], seen))
+                      for name in sorted(_global_names(obj.__code__)) if name in obj.__globals__]
+        return repr(('function', _fingerprint(obj.__code__, seen), _fingerprint(obj.__defaults__, seen),
+                     _fingerprint(obj.__kwdefaults__, seen), _fingerprint(closure, seen), referenced))
+
+    raise ValueError('Cannot fingerprint object of type {}.'.format(type(obj).__name__))
+
+
+class DetectionCache:
+    """
+    An on-disk cache of detection results. Each entry is keyed on a hash of the height model array, its affine
+    transformation and the parameters of the detector (including a fingerprint of any variable window function), such
+    that rerunning an unchanged detector on an unchanged raster skips detection entirely.
+
+    The total size of the cache directory is bounded by ``max_bytes``. When exceeded, the least recently used entries
+    are evicted first.
+    """
+
+    def __init__(self, cache_dir, max_bytes=2**30):
+        """
+        :param cache_dir: The directory in which to store cached detections. Created if it does not exist.
+        :param max_bytes: The maximum total size of the cached entries, in bytes.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+    def _key(self, detector, height_model):
+        """
+        Computes the cache key for a given detector and height model.
+
+        :param detector: A ``LocalMaximaBase`` derivative.
+        :param height_model: A ``HeightModel`` object.
+        :return: A hex digest string, or ``None`` if the detector parameters cannot be described deterministically.
+        """
+        try:
+            params = _fingerprint(detector._cache_params())
+        except (ValueError, RecursionError):
+            return None
+
+        if isinstance(height_model, SparseHeightModel):
+            arrays = [height_model.rows, height_model.cols, height_model.heights]
+        else:
+            arrays = [height_model.array]
+        affine = None if height_model.affine is None else tuple(height_model.affine)
+
+        h = hashlib.sha1()
+        h.update(repr(CACHE_VERSION).encode())
+        h.update(type(detector).__name__.encode())
+        h.update(type(height_model).__name__.encode())
+        h.update(str(height_model.shape).encode())
+        for array in arrays:
+            array = np.ascontiguousarray(array)
+            h.update(str(array.dtype).encode())
+            h.update(array.tobytes())
+        h.update(repr(affine).encode())
+        h.update(params.encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npy')
+
+    def _entries(self):
+        """
+        :return: A list of (path, last access time, size) for every entry in the cache, least recently used first.
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npy'):
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Removed by another process since listing
+                    continue
+                entries.append((path, stat.st_mtime, stat.st_size))
+        return sorted(entries, key=lambda entry: entry[1])
+
+    def _evict(self):
+        """
+        Removes the least recently used entries until the cache fits within ``max_bytes``.
+        """
+        entries = self._entries()
+        total = sum(entry[2] for entry in entries)
+
+        for path, _, size in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def get(self, detector, height_model):
+        """
+        Retrieves a cached detection.
+
+        :param detector: A ``LocalMaximaBase`` derivative.
+        :param height_model: A ``HeightModel`` object.
+        :return: A ``DetectionBase`` object, or ``None`` if there is no entry for this detector and height model.
+        """
+        key = self._key(detector, height_model)
+        if key is None:
+            return None
+
+        # The entry may be missing, evicted by another process, or corrupt; all are treated as a miss
+        path = self._path(key)
+        try:
+            # Refresh the modification time, which is used as the last access time for eviction
+            os.utime(path, None)
+            detected = np.load(path, allow_pickle=False)
+        except (OSError, ValueError, EOFError):
+            return None
+
+        if isinstance(height_model, SparseHeightModel):
+            return SparseDetectionBase(detected, height_model)
+        return DetectionBase(detected, height_model)
+
+    def put(self, detector, height_model, detection):
+        """
+        Stores a detection in the cache, evicting old entries if necessary. Nothing is stored if the detector parameters
+        cannot be described deterministically.
+
+        :param detector: A ``LocalMaximaBase`` derivative.
+        :param height_model: A ``HeightModel`` object.
+        :param detection: The ``DetectionBase`` object produced by ``detector`` on ``height_model``.
+        """
+        key = self._key(detector, height_model)
+        if key is None:
+            return
+
+        # Write to a unique temporary file first so partially written entries are never read, even with concurrent
+        # writers of the same key
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, np.asarray(detection.detected), allow_pickle=False)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+        self._evict()
+
+    def clear(self):
+        """
+        Removes all entries from the cache.
+        """
+        for path, _, _ in self._entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
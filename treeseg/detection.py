@@ -1,5 +1,5 @@
 import numpy as np
-from treeseg.base import DetectionBase, SegmentationBase
+from treeseg.base import DetectionBase, SegmentationBase, SparseHeightModel, SparseDetectionBase
 
 class LocalMaximaBase:
     """
@@ -7,7 +7,7 @@ class LocalMaximaBase:
     handles a transformation of inputs from the user (e.g. in meters) into pixels.
     """
 
-    def __init__(self, min_distance=1, threshold_abs=None, exclude_border=True, num_peaks=np.inf):
+    def __init__(self, min_distance=1, threshold_abs=None, exclude_border=True, num_peaks=np.inf, cache=None):
         """
         This is not a strict wrapper for ``peak_local_max`` and is designed specifically to handle the spatial
         referencing. See ``peak_local_max`` documentation for particulars.
@@ -15,12 +15,48 @@ class LocalMaximaBase:
         :param threshold_abs: Minimum intensity of maxima.
         :param exclude_border: Excludes maxima found at the distance specified as an integer to this argument, in the units of the coordinate system.
         :param num_peaks: The maximum number of maxima to return.
+        :param cache: An optional ``treeseg.cache.DetectionCache``. If given, detections are retrieved from and stored
+        in this cache.
         """
 
         self.min_distance = min_distance
         self.threshold_abs = threshold_abs
         self.exclude_border = exclude_border
         self.num_peaks = num_peaks
+        self.cache = cache
+
+    def _cache_params(self):
+        """
+        :return: A dictionary of the parameters that determine the output of this detector, used to key the cache.
+        """
+        return {'min_distance': self.min_distance, 'threshold_abs': self.threshold_abs,
+                'exclude_border': self.exclude_border, 'num_peaks': self.num_peaks}
+
+    def _detect(self, height_model):
+        """
+        Runs the detection without consulting the cache. Derivatives must implement this, rather than ``detect``, so
+        that caching is handled by the base class.
+
+        :param height_model: A ``HeightModel`` object.
+        :return: A ``DetectionBase`` object.
+        """
+        raise NotImplementedError
+
+    def detect(self, height_model):
+        """
+        Detects the local maxima of a height model, using the cache if one is set.
+
+        :param height_model: A ``HeightModel`` object.
+        :return: A ``DetectionBase`` object.
+        """
+        if self.cache is None:
+            return self._detect(height_model)
+
+        detection = self.cache.get(self, height_model)
+        if detection is None:
+            detection = self._detect(height_model)
+            self.cache.put(self, height_model, detection)
+        return detection
 
     def _convert_min_dist(self, affine):
         """
@@ -47,8 +83,11 @@ class FixedWindowLocalMaxima(LocalMaximaBase):
     Implements a local maxima detection filter via ``skimage.feature.peak_local_max``.
     """
 
-    def detect(self, height_model):
+    def _detect(self, height_model):
         from skimage.feature import peak_local_max
+        if isinstance(height_model, SparseHeightModel):
+            raise ValueError('FixedWindowLocalMaxima requires a dense height model.')
+
         detect_array = peak_local_max(height_model.array, min_distance=self._get_pixel_min_dist,
                                       threshold_abs=self.threshold_abs, exclude_border=self.exclude_border,
                                       num_peaks=self.num_peaks, indices=False)
@@ -77,12 +116,14 @@ class VariableWindowLocalMaxima(LocalMaximaBase):
         :param resolution: The resolution of the height model.
         :param i: The row position of the height model.
         :param j: The col position of the height model.
-        :return: A tuple that contains two tuples describing the bounding box of the window in array space.
+        :return: A tuple that contains two tuples describing the bounding box of the window in array space. Lower bounds
+        are clamped to zero, such that windows are truncated at the top and left edges as they are at the bottom and
+        right edges by slicing.
         """
 
         diff = int(np.ceil(units / resolution) // 2)
-        lb_i, ub_i = i - diff, i + diff
-        lb_j, ub_j = j - diff, j + diff
+        lb_i, ub_i = max(i - diff, 0), i + diff
+        lb_j, ub_j = max(j - diff, 0), j + diff
         return ((lb_i, ub_i), (lb_j, ub_j))
 
     @property
@@ -93,6 +134,11 @@ class VariableWindowLocalMaxima(LocalMaximaBase):
     def variable_window_function(self, func):
         self.__variable_window_function = func
 
+    def _cache_params(self):
+        params = super(VariableWindowLocalMaxima, self)._cache_params()
+        params['variable_window_function'] = self.variable_window_function
+        return params
+
     def _get_window(self, array, resolution, i, j):
         """
         :param array: Some input array
@@ -152,8 +198,94 @@ class VariableWindowLocalMaxima(LocalMaximaBase):
         return coord[::-1]
 
     def detect(self, height_model, diagnostic=False):
+        # Diagnostic output contains window polygons, which are not cached
+        if diagnostic:
+            if isinstance(height_model, SparseHeightModel):
+                raise ValueError('Diagnostic output requires a dense height model.')
+            return self._detect(height_model, diagnostic=True)
+        return super(VariableWindowLocalMaxima, self).detect(height_model)
+
+    def _sparse_maximum_filter(self, height_model):
+        """
+        The equivalent of ``scipy.ndimage.maximum_filter`` on the occupied cells of a ``SparseHeightModel``. Unoccupied
+        cells do not contribute to the maximum.
+
+        :param height_model: A ``SparseHeightModel`` object.
+        :return: An array of the maximum height in the neighborhood of each occupied cell.
+        """
+        keys = height_model._keys
+        max_heights = height_model.heights.copy()
+        n_rows, n_cols = height_model.shape
+
+        # Truncate the filter size and place its origin as maximum_filter does, so fractional distances match
+        size = int(2 * self.min_distance + 1)
+        offsets = range(-(size // 2), size - size // 2)
+
+        for d_row in offsets:
+            for d_col in offsets:
+                rows, cols = height_model.rows + d_row, height_model.cols + d_col
+                valid = (rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols)
+                neighbor_keys = rows * n_cols + cols
+
+                pos = np.searchsorted(keys, neighbor_keys)
+                pos[pos == len(keys)] = 0
+                found = valid & (keys[pos] == neighbor_keys)
+                max_heights[found] = np.maximum(max_heights[found], height_model.heights[pos[found]])
+        return max_heights
+
+    def detect_xyz(self, x, y, z, cell_size, crs=None):
+        """
+        Detects local maxima directly from point coordinates, without building a dense height model. Points are binned
+        into a ``SparseHeightModel``, such that memory grows with the number of occupied cells. Unoccupied cells are
+        never detected.
+
+        :param x: An array of x coordinates.
+        :param y: An array of y coordinates.
+        :param z: An array of heights (e.g. normalized point heights).
+        :param cell_size: The width and height of each cell, in the units of the coordinate system.
+        :param crs: The coordinate reference system of the points.
+        :return: A ``SparseDetectionBase`` object.
+        """
+        return self.detect(SparseHeightModel.from_xyz(x, y, z, cell_size, crs=crs))
+
+    def _detect_sparse(self, height_model):
+        """
+        Runs the variable window local maxima on a ``SparseHeightModel``. The windows are identical to those of the
+        dense implementation, but only occupied cells are candidates and only occupied cells contribute to the window
+        maxima.
+
+        :param height_model: A ``SparseHeightModel`` object.
+        :return: A ``SparseDetectionBase`` object.
+        """
+        heights = height_model.heights
+        mask = heights == self._sparse_maximum_filter(height_model)
+
+        if self.threshold_abs is not None:
+            mask &= heights > self.threshold_abs
+
+        detected = []
+        for ix in np.nonzero(mask)[0]:
+            row, col = int(height_model.rows[ix]), int(height_model.cols[ix])
+            window_width = self.variable_window_function(heights[ix])
+            bounds = self._units_to_pixel_bounds(window_width, height_model.cell_size_x, row, col)
+
+            # Slicing a range clips the upper bounds as slicing the dense array does
+            row_range = range(height_model.shape[0])[bounds[0][0]:bounds[0][1]]
+            col_range = range(height_model.shape[1])[bounds[1][0]:bounds[1][1]]
+
+            if row in row_range and col in col_range:
+                if heights[ix] >= height_model._window_max(row_range, col_range):
+                    detected.append((row, col))
+
+        detected = np.array(detected, dtype=np.int64).reshape(-1, 2)
+        return SparseDetectionBase(detected, height_model)
+
+    def _detect(self, height_model, diagnostic=False):
         from scipy.ndimage.filters import maximum_filter
 
+        if isinstance(height_model, SparseHeightModel):
+            return self._detect_sparse(height_model)
+
         array = height_model.array
         max_array = maximum_filter(array, size= 2 * self.min_distance + 1, mode='constant')
         mask = array == max_array
@@ -17,9 +17,9 @@ class Voronoi:
         :return:
         """
 
-        array = self.detection_base.height_model.array
-        height, width = self.detection_base.height_model.cell_size_x * array.shape[0], \
-                        self.detection_base.height_model.cell_size_y * array.shape[1]
+        shape = self.detection_base.height_model.shape
+        height, width = self.detection_base.height_model.cell_size_x * shape[0], \
+                        self.detection_base.height_model.cell_size_y * shape[1]
         min_x, min_y = self.detection_base.height_model._bounding_box[0], \
                        self.detection_base.height_model._bounding_box[2]
 
@@ -33,9 +33,9 @@ class Voronoi:
         :return:
         """
 
-        array = self.detection_base.height_model.array
-        height, width = self.detection_base.height_model.cell_size_x * array.shape[0], \
-                        self.detection_base.height_model.cell_size_y * array.shape[1]
+        shape = self.detection_base.height_model.shape
+        height, width = self.detection_base.height_model.cell_size_x * shape[0], \
+                        self.detection_base.height_model.cell_size_y * shape[1]
         min_x, min_y = self.detection_base.height_model._bounding_box[0], \
                        self.detection_base.height_model._bounding_box[2]
 
@@ -9,6 +9,8 @@ from affine import Affine
 rasterio_object = rasterio.open('data/test.tif')
 array = rasterio_object.read(1)
 
+SCALE = 1.0
+
 class HeightModelTestCase(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -44,3 +46,170 @@ class HeightModelTestCase(unittest.TestCase):
         self.assertEqual(type(hm.affine), Affine)
 
 
+
+class DetectionCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.cache_dir = tempfile.mkdtemp()
+        self.hm = base.HeightModel(array, affine=rasterio_object.transform)
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.cache_dir)
+
+    def test_hit_skips_detection(self):
+        det_cache = cache.DetectionCache(self.cache_dir)
+        detector = detection.VariableWindowLocalMaxima(min_distance=1, cache=det_cache)
+        first = detector.detect(self.hm)
+
+        detector._detect = None # A hit must not call the underlying detection
+        second = detector.detect(self.hm)
+        np.testing.assert_array_equal(first.detected, second.detected)
+
+    def test_window_function_changes_key(self):
+        det_cache = cache.DetectionCache(self.cache_dir)
+        a = detection.VariableWindowLocalMaxima(a=2.21)
+        b = detection.VariableWindowLocalMaxima(a=3.0)
+        self.assertNotEqual(det_cache._key(a, self.hm), det_cache._key(b, self.hm))
+        self.assertEqual(det_cache._key(a, self.hm), det_cache._key(detection.VariableWindowLocalMaxima(a=2.21), self.hm))
+
+    def test_eviction(self):
+        det_cache = cache.DetectionCache(self.cache_dir, max_bytes=0)
+        detection.VariableWindowLocalMaxima(cache=det_cache).detect(self.hm)
+        self.assertEqual(len(det_cache._entries()), 0)
+
+    def test_window_function_globals_change_key(self):
+        global SCALE
+        det_cache = cache.DetectionCache(self.cache_dir)
+        detector = detection.VariableWindowLocalMaxima()
+        detector.variable_window_function = lambda height: SCALE * height
+
+        key = det_cache._key(detector, self.hm)
+        SCALE = 2.0
+        try:
+            self.assertNotEqual(key, det_cache._key(detector, self.hm))
+        finally:
+            SCALE = 1.0
+
+    def test_window_function_key_is_stable(self):
+        from functools import partial
+        det_cache = cache.DetectionCache(self.cache_dir)
+
+        def make_detector():
+            detector = detection.VariableWindowLocalMaxima()
+            detector.variable_window_function = partial(lambda height, a: sum([a * h for h in [height]]), a=2.0)
+            return detector
+
+        key = det_cache._key(make_detector(), self.hm)
+        self.assertIsNotNone(key)
+        self.assertEqual(key, det_cache._key(make_detector(), self.hm))
+
+    def test_self_referential_closure(self):
+        coefs = [2.0]
+        coefs.append(coefs)
+
+        det_cache = cache.DetectionCache(self.cache_dir)
+        detector = detection.VariableWindowLocalMaxima(cache=det_cache)
+        detector.variable_window_function = lambda height: coefs[0] * height
+        self.assertIsNotNone(det_cache._key(detector, self.hm))
+        detector.detect(self.hm)
+
+    def test_attribute_names_not_resolved_as_globals(self):
+        # ``array`` is a module global here, but is only an attribute of ``np`` in this function
+        self.assertEqual(cache._global_names((lambda height: np.array(height)).__code__), {'np'})
+
+    def test_version_changes_key(self):
+        det_cache = cache.DetectionCache(self.cache_dir)
+        detector = detection.VariableWindowLocalMaxima()
+        key = det_cache._key(detector, self.hm)
+
+        version = cache.CACHE_VERSION
+        cache.CACHE_VERSION = version + 1
+        try:
+            self.assertNotEqual(key, det_cache._key(detector, self.hm))
+        finally:
+            cache.CACHE_VERSION = version
+
+    def test_unfingerprintable_bypasses_cache(self):
+        class Window:
+            def __call__(self, height):
+                return 2 * height
+
+        det_cache = cache.DetectionCache(self.cache_dir)
+        detector = detection.VariableWindowLocalMaxima(cache=det_cache)
+        detector.variable_window_function = Window()
+        detector.detect(self.hm)
+        self.assertIsNone(det_cache._key(detector, self.hm))
+        self.assertEqual(len(det_cache._entries()), 0)
+
+class SparseHeightModelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.array = np.clip(np.nan_to_num(array), 0, None)
+        rows, cols = np.indices(self.array.shape)
+        self.x, self.y, self.z = cols.ravel() + 0.5, -rows.ravel() - 0.5, self.array.ravel()
+
+    def test_from_xyz_max_height(self):
+        x, y, z = np.array([0.2, 0.7, 1.5, 0.1]), np.array([0.1, 0.9, 0.5, 0.4]), np.array([1., 3., 2., 0.5])
+        hm = base.SparseHeightModel.from_xyz(x, y, z, 1)
+        self.assertEqual(hm.shape, (1, 2))
+        np.testing.assert_array_equal(hm.heights, [3., 2.])
+
+    def test_matches_dense_detection(self):
+        detector = detection.VariableWindowLocalMaxima(min_distance=1)
+        sparse = detector.detect_xyz(self.x, self.y, self.z, 1)
+        dense = detector.detect(base.HeightModel(self.array, affine=sparse.height_model.affine))
+
+        np.testing.assert_array_equal(sparse.detected, np.stack(np.where(dense.detected), axis=1))
+        np.testing.assert_allclose(sparse._coords_array_single, dense._coords_array_single)
+
+    def test_matches_dense_fractional_min_distance(self):
+        detector = detection.VariableWindowLocalMaxima(min_distance=1.5)
+        sparse = detector.detect_xyz(self.x, self.y, self.z, 1)
+        dense = detector.detect(base.HeightModel(self.array, affine=sparse.height_model.affine))
+        np.testing.assert_array_equal(sparse.detected, np.stack(np.where(dense.detected), axis=1))
+
+    def test_matches_dense_small_grids(self):
+        # Windows that extend past the top and left edges are truncated identically by both paths
+        rng = np.random.RandomState(0)
+        for _ in range(50):
+            heights = rng.uniform(1, 30, rng.randint(1, 20, 2))
+            rows, cols = np.indices(heights.shape)
+
+            detector = detection.VariableWindowLocalMaxima(min_distance=rng.choice([0.5, 1, 1.5, 2]))
+            sparse = detector.detect_xyz(cols.ravel() + 0.5, -rows.ravel() - 0.5, heights.ravel(), 1)
+            dense = detector.detect(base.HeightModel(heights, affine=sparse.height_model.affine))
+            np.testing.assert_array_equal(sparse.detected, np.stack(np.where(dense.detected), axis=1))
+
+    def test_unoccupied_cells_not_detected(self):
+        # On sparse points, detections are the dense detections restricted to occupied cells
+        rng = np.random.RandomState(0)
+        x, y, z = rng.uniform(0, 200, 2000), rng.uniform(0, 200, 2000), rng.uniform(1, 30, 2000)
+
+        detector = detection.VariableWindowLocalMaxima(min_distance=1)
+        sparse = detector.detect_xyz(x, y, z, 1)
+        hm = sparse.height_model
+        dense = detector.detect(hm.to_dense())
+
+        occupied = np.zeros(hm.shape, dtype=bool)
+        occupied[hm.rows, hm.cols] = True
+        np.testing.assert_array_equal(sparse.detected, np.stack(np.where(dense.detected * occupied), axis=1))
+
+    def test_not_dense_height_model(self):
+        hm = base.SparseHeightModel.from_xyz(self.x, self.y, self.z, 1)
+        self.assertIsInstance(hm, base.HeightModelBase)
+        self.assertNotIsInstance(hm, base.HeightModel)
+        self.assertFalse(hasattr(hm, 'from_tif'))
+
+    def test_empty_input(self):
+        with self.assertRaises(ValueError):
+            base.SparseHeightModel.from_xyz([], [], [], 1)
+
+    def test_voronoi(self):
+        detector = detection.VariableWindowLocalMaxima(min_distance=1)
+        sparse = detector.detect_xyz(self.x, self.y, self.z, 1)
+        dense = detector.detect(base.HeightModel(self.array, affine=sparse.height_model.affine))
+
+        sparse_polys = segmentation.Voronoi(sparse).segment()
+        dense_polys = segmentation.Voronoi(dense).segment()
+        self.assertEqual(len(sparse_polys), len(dense_polys))
+        np.testing.assert_allclose(sparse_polys.area.sum(), dense_polys.area.sum())